@@ -8,6 +8,7 @@ import dotenv
 
 from curses import wrapper
 from getpass import getpass
+from protocol import MessageKind, FLAG_DIRECT, unpack_envelope, now_ms
 
 
 class ChatClient:
@@ -20,12 +21,14 @@ class ChatClient:
         self.private_key = None
         self.server_public_key = None
         self.username = "Anonymous"
-        self.message_history = []
+        self.message_history = []  # List of (kind, sender, message) tuples, kind is None for local notices
         self.input_str = ""
         self.stdscr = None
         self.send_message_flag = False
         self.connected = False
         self.user_count = 1  # Default to 1 (self)
+        self.last_seq = None  # Last room sequence number seen
+        self.latency_ms = None  # Client clock minus server timestamp of the last message
         self.key_folder = "keys"  # Folder to store keys
         self.env_file = ".env"  # Environment file to store password
         
@@ -132,12 +135,13 @@ class ChatClient:
             
             # Wait for authentication response
             encrypted_auth_response = self.client_socket.recv(self.encryption_size)
-            auth_response = rsa.decrypt(encrypted_auth_response, self.private_key).decode()
+            auth_response = unpack_envelope(
+                rsa.decrypt(encrypted_auth_response, self.private_key)
+            )
             
             # Check if authentication was successful
-            if auth_response.startswith("AUTHFAILED:"):
-                error_message = auth_response.split(":", 1)[1]
-                print(f"Authentication failed: {error_message}")
+            if auth_response.kind == MessageKind.AUTHFAILED:
+                print(f"Authentication failed: {auth_response.body}")
                 
                 # Remove password from .env if it's incorrect
                 password_key = f"CHAT_PASSWORD_{self.server_ip.replace('.', '_')}"
@@ -191,25 +195,31 @@ class ChatClient:
             try:
                 encrypted_message = self.client_socket.recv(self.encryption_size)
                 if not encrypted_message:
-                    self.message_history.append(("system", "Disconnected from server"))
+                    self.message_history.append((None, "system", "Disconnected from server"))
                     self.update_screen()
                     self.connected = False
                     break
 
-                message = rsa.decrypt(encrypted_message, self.private_key).decode()
+                envelope = unpack_envelope(
+                    rsa.decrypt(encrypted_message, self.private_key)
+                )
+                # This is a wall clock difference between two machines, so it is
+                # only a delivery time if both clocks are in sync. It is kept signed,
+                # a negative value means the client clock is behind the server's
+                self.latency_ms = now_ms() - envelope.timestamp_ms
+                self.check_sequence(envelope.seq, envelope.flags & FLAG_DIRECT)
+
+                # Skip kinds from newer servers, the sequence still counts them
+                if not isinstance(envelope.kind, MessageKind):
+                    continue
 
                 # Check if this is a system message for user count
-                if message.startswith("USERCOUNT:"):
-                    self.user_count = int(message.split(":", 1)[1])
+                if envelope.kind == MessageKind.USERCOUNT:
+                    self.user_count = int(envelope.body)
                     self.update_screen()
                     continue
 
-                # Split the message into sender and content
-                if ": " in message:
-                    sender, content = message.split(": ", 1)
-                    self.message_history.append((sender, content))
-                else:
-                    self.message_history.append(("system", message))
+                self.message_history.append((envelope.kind, envelope.sender, envelope.body))
 
                 # print("\a") # SO ANNOYING
 
@@ -217,12 +227,36 @@ class ChatClient:
 
             except Exception as e:
                 self.message_history.append(
-                    ("system", f"Error receiving message: {str(e)}")
+                    (None, "system", f"Error receiving message: {str(e)}")
                 )
                 self.update_screen()
                 self.connected = False
                 break
 
+    def check_sequence(self, seq, direct=False):
+        """Track the room sequence number and report missed or out of order messages"""
+        if direct:
+            # Direct messages carry the current sequence without advancing it,
+            # anything before it was never meant for us (like our own join message)
+            if self.last_seq is None or seq > self.last_seq:
+                self.last_seq = seq
+            return
+
+        if self.last_seq is None or seq == self.last_seq + 1:
+            self.last_seq = seq
+        elif seq > self.last_seq + 1:
+            missed = seq - self.last_seq - 1
+            self.message_history.append(
+                (None, "system", f"Missed {missed} message(s) from the server")
+            )
+            self.last_seq = seq
+        elif seq == self.last_seq:
+            self.message_history.append((None, "system", f"Message #{seq} arrived twice"))
+        else:
+            self.message_history.append(
+                (None, "system", f"Message #{seq} arrived out of order (after #{self.last_seq})")
+            )
+
     def sending_messages(self):
         """Thread function to send messages to the server"""
         while self.connected:
@@ -246,7 +280,7 @@ class ChatClient:
 
             except Exception as e:
                 self.message_history.append(
-                    ("system", f"Error sending message: {str(e)}")
+                    (None, "system", f"Error sending message: {str(e)}")
                 )
                 self.update_screen()
                 self.connected = False
@@ -269,17 +303,20 @@ class ChatClient:
 
         # Draw a header with user count
         header = f" ~ the void ~ | {self.username} on {self.server_ip}:{self.server_port} | users: {self.user_count} "
+        if self.latency_ms is not None:
+            header += f"| latency: ~{self.latency_ms}ms (clock diff) "
         self.stdscr.addstr(0, max(0, (width - len(header)) // 2), header[: width - 1])
         self.stdscr.addstr(1, 0, "=" * width)
 
-        for i, (sender, msg) in enumerate(self.message_history[start_index:]):
+        for i, (kind, sender, msg) in enumerate(self.message_history[start_index:]):
             if i >= max_messages:
                 break
 
-            # Format the message based on sender
-            if sender == "system":
+            # Format the message based on its kind, never on the sender name
+            # (anyone can pick "SERVER" as their username)
+            if kind is None:
                 message_text = f"[SYSTEM] {msg}"
-            elif sender == "SERVER":
+            elif kind == MessageKind.SERVER:
                 message_text = f"[SERVER] {msg}"
             else:
                 message_text = f"{sender}: {msg}"
@@ -323,8 +360,8 @@ class ChatClient:
         send_thread.start()
 
         # Add a welcome message
-        self.message_history.append(("system", f"Connected as {self.username}"))
-        self.message_history.append(("system", "Press ESC to exit"))
+        self.message_history.append((None, "system", f"Connected as {self.username}"))
+        self.message_history.append((None, "system", "Press ESC to exit"))
 
         # Initial screen update
         self.update_screen()
@@ -358,7 +395,7 @@ class ChatClient:
             except KeyboardInterrupt:
                 break
             except Exception as e:
-                self.message_history.append(("system", f"Error: {str(e)}"))
+                self.message_history.append((None, "system", f"Error: {str(e)}"))
                 time.sleep(1)
 
         # Clean up
@@ -0,0 +1,94 @@
+import struct
+import time
+
+from enum import IntEnum
+from typing import NamedTuple
+
+
+class MessageKind(IntEnum):
+    CHAT = 1
+    SERVER = 2
+    USERCOUNT = 3
+    AUTHSUCCESS = 4
+    AUTHFAILED = 5
+
+
+# kind, flags, sender id, sequence number, server timestamp (ms), sender name length
+HEADER = struct.Struct("!BBIIQB")
+
+# Sent to a single client, carries the current room sequence without advancing it
+FLAG_DIRECT = 0x01
+
+SERVER_SENDER_ID = 0
+SERVER_SENDER_NAME = "SERVER"
+MAX_SENDER_LENGTH = 255
+TRUNCATED_SUFFIX = "... (message truncated)".encode()
+
+
+class Envelope(NamedTuple):
+    kind: MessageKind  # Plain int for kinds this version doesn't know about
+    flags: int
+    sender_id: int
+    sender: str
+    seq: int
+    timestamp_ms: int
+    body: str
+
+
+def now_ms():
+    """Current wall clock time in milliseconds"""
+    return time.time_ns() // 1_000_000
+
+
+def pack_envelope(kind, sender_id, sender, seq, body, max_size=None, timestamp_ms=None, flags=0):
+    """Pack a message into a binary envelope, truncating the sender and body to fit max_size"""
+    if timestamp_ms is None:
+        timestamp_ms = now_ms()
+
+    max_sender_length = MAX_SENDER_LENGTH
+    if max_size is not None:
+        # Leave room for the header and at least the truncation suffix
+        max_sender_length = min(
+            max_sender_length, max_size - HEADER.size - len(TRUNCATED_SUFFIX)
+        )
+        if max_sender_length < 0:
+            raise ValueError(f"max_size of {max_size} bytes is too small for an envelope")
+
+    # Cut on a character boundary so the sender still decodes cleanly
+    sender_bytes = sender.encode()[:max_sender_length].decode(errors="ignore").encode()
+    body_bytes = body.encode()
+    header = HEADER.pack(kind, flags, sender_id, seq, timestamp_ms, len(sender_bytes))
+
+    if max_size is not None:
+        max_body_length = max_size - len(header) - len(sender_bytes)
+        if len(body_bytes) > max_body_length:
+            # Cut on a character boundary so the body still decodes cleanly
+            keep = max(0, max_body_length - len(TRUNCATED_SUFFIX))
+            body_bytes = (
+                body_bytes[:keep].decode(errors="ignore").encode() + TRUNCATED_SUFFIX
+            )
+
+    return header + sender_bytes + body_bytes
+
+
+def unpack_envelope(data):
+    """Unpack a binary envelope produced by pack_envelope
+
+    Kinds added by newer servers are returned as plain ints so the caller
+    can skip them instead of dropping the connection.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError(f"Envelope too short ({len(data)} bytes)")
+
+    kind, flags, sender_id, seq, timestamp_ms, sender_length = HEADER.unpack_from(data)
+    sender_end = HEADER.size + sender_length
+    if len(data) < sender_end:
+        raise ValueError("Envelope sender field is truncated")
+
+    sender = data[HEADER.size:sender_end].decode(errors="replace")
+    body = data[sender_end:].decode(errors="replace")
+    try:
+        kind = MessageKind(kind)
+    except ValueError:
+        pass
+    return Envelope(kind, flags, sender_id, sender, seq, timestamp_ms, body)
@@ -3,8 +3,10 @@ import threading
 import rsa
 import os
 import hashlib
+import queue
 
 from getpass import getpass
+from protocol import MessageKind, FLAG_DIRECT, SERVER_SENDER_ID, SERVER_SENDER_NAME, pack_envelope
 
 
 class ChatServer:
@@ -13,9 +15,19 @@ class ChatServer:
         self.port = port
         self.encryption_size = encryption_size
         self.server_socket = None
-        self.clients = []  # List of (client_socket, client_address, public_key, username) tuples
+        self.clients = []  # List of (client_socket, client_address, public_key, username, sender_id, send_queue) tuples
         self.public_key = None
         self.private_key = None
+
+        # Room state, guarded by the lock so sequence numbers are queued in order.
+        # Only packing and queueing happen under it, each client's writer thread
+        # does the encrypting and sending so a slow client can't stall the room
+        self.lock = threading.RLock()
+        self.seq = 0  # Sequence number of the last room-wide message
+        self.next_sender_id = SERVER_SENDER_ID + 1
+
+        # RSA can only encrypt limited amount of data (PKCS#1 v1.5 padding needs 11 bytes)
+        self.max_payload_size = self.encryption_size // 8 - 11
         
         # Password configuration
         self.password = None
@@ -101,38 +113,53 @@ class ChatServer:
             if not self.check_password(password):
                 print(f"Authentication failed for client {client_address}")
                 # Send authentication failed message
-                auth_failed_msg = "AUTHFAILED:Incorrect password."
-                encrypted_auth_failed = rsa.encrypt(auth_failed_msg.encode(), client_public_key)
-                client_socket.send(encrypted_auth_failed)
+                self.send_message_to_client(
+                    client_socket, client_public_key, MessageKind.AUTHFAILED,
+                    SERVER_SENDER_ID, SERVER_SENDER_NAME, "Incorrect password."
+                )
                 client_socket.close()
                 return
                 
             # Send authentication success message
-            auth_success_msg = "AUTHSUCCESS:Authentication successful."
-            encrypted_auth_success = rsa.encrypt(auth_success_msg.encode(), client_public_key)
-            client_socket.send(encrypted_auth_success)
+            self.send_message_to_client(
+                client_socket, client_public_key, MessageKind.AUTHSUCCESS,
+                SERVER_SENDER_ID, SERVER_SENDER_NAME, "Authentication successful."
+            )
 
             # Get client username
             encrypted_username = client_socket.recv(self.encryption_size)
             username = rsa.decrypt(encrypted_username, self.private_key).decode()
 
-            # Add client to clients list
-            client_info = (client_socket, client_address, client_public_key, username)
-            self.clients.append(client_info)
+            # Start a thread that sends this client's queued messages in order
+            send_queue = queue.Queue()
+            writer_thread = threading.Thread(
+                target=self.client_writer, args=(client_socket, client_public_key, send_queue)
+            )
+            writer_thread.daemon = True
+            writer_thread.start()
 
-            # Send current user count to all clients
-            user_count_msg = f"USERCOUNT:{len(self.clients)}"
-            self.broadcast_system_message(user_count_msg)
+            # Hold the lock while joining so no other message can slip in
+            # before the welcome message tells the client the current sequence
+            with self.lock:
+                sender_id = self.next_sender_id
+                self.next_sender_id += 1
 
-            # Broadcast join message
-            join_message = f"{username} has joined the chat"
-            self.broadcast_message("SERVER", join_message, client_socket)
+                # Add client to clients list
+                client_info = (client_socket, client_address, client_public_key, username, sender_id, send_queue)
+                self.clients.append(client_info)
 
-            # Send welcome message to the client
-            welcome_msg = f"Welcome to the chat, {username}!"
-            self.send_message_to_client(
-                client_socket, client_public_key, "SERVER", welcome_msg
-            )
+                # Send current user count to all clients
+                self.broadcast_system_message(MessageKind.USERCOUNT, str(len(self.clients)))
+
+                # Broadcast join message
+                join_message = f"{username} has joined the chat"
+                self.broadcast_message(SERVER_SENDER_NAME, join_message, client_socket)
+
+                # Send welcome message to the client
+                welcome_msg = f"Welcome to the chat, {username}!"
+                send_queue.put(self.pack_direct_message(
+                    MessageKind.SERVER, SERVER_SENDER_ID, SERVER_SENDER_NAME, welcome_msg
+                ))
 
             # Handle client messages
             while True:
@@ -145,7 +172,7 @@ class ChatServer:
                     print(f"Message from {username}: {message}")
 
                     # Broadcast message to all clients INCLUDING the sender
-                    self.broadcast_message(username, message)
+                    self.broadcast_message(username, message, sender_id=sender_id)
 
                 except Exception as e:
                     print(f"Error receiving message from {username}: {str(e)}")
@@ -158,66 +185,91 @@ class ChatServer:
             self.remove_client(client_socket)
             client_socket.close()
 
-    def broadcast_message(self, sender, message, exclude_socket=None):
+    def broadcast_message(self, sender, message, exclude_socket=None, sender_id=SERVER_SENDER_ID):
         """Send a message to all clients except those in exclude_socket"""
-        for client in self.clients[
-            :
-        ]:  # Create a copy of the list to avoid issues if list changes
-            client_socket, _, client_public_key, _ = client
+        kind = MessageKind.SERVER if sender_id == SERVER_SENDER_ID else MessageKind.CHAT
+        self.broadcast_envelope(kind, sender_id, sender, message, exclude_socket)
 
-            # Skip excluded sockets (if any)
-            if exclude_socket is not None and client_socket == exclude_socket:
-                continue
+    def broadcast_system_message(self, kind, message):
+        """Send a system message to all clients"""
+        self.broadcast_envelope(kind, SERVER_SENDER_ID, SERVER_SENDER_NAME, message)
 
+    def broadcast_envelope(self, kind, sender_id, sender, message, exclude_socket=None):
+        """Assign the next room sequence number and queue the envelope for all clients"""
+        with self.lock:
+            # Pack once, only the encryption differs per client
             try:
-                self.send_message_to_client(
-                    client_socket, client_public_key, sender, message
+                payload = pack_envelope(
+                    kind, sender_id, sender, self.seq + 1, message, self.max_payload_size
                 )
-            except Exception:
-                # If sending fails, assume client disconnected
-                self.remove_client(client_socket)
+            except ValueError as e:
+                print(f"Error packing message from {sender}: {str(e)}")
+                return
+            self.seq += 1
+
+            for client in self.clients:
+                client_socket, _, _, _, _, send_queue = client
+
+                # Skip excluded sockets (if any)
+                if exclude_socket is not None and client_socket == exclude_socket:
+                    continue
+
+                send_queue.put(payload)
+
+    def pack_direct_message(self, kind, sender_id, sender, message):
+        """Pack a message meant for a single client"""
+        # Direct messages don't advance the room sequence, they carry the
+        # current one so the client knows where the room is at
+        return pack_envelope(
+            kind, sender_id, sender, self.seq, message, self.max_payload_size,
+            flags=FLAG_DIRECT
+        )
+
+    def send_message_to_client(self, client_socket, client_public_key, kind, sender_id, sender, message):
+        """Encrypt and send a message to a client that hasn't joined the room yet"""
+        payload = self.pack_direct_message(kind, sender_id, sender, message)
+        encrypted_message = rsa.encrypt(payload, client_public_key)
+        client_socket.send(encrypted_message)
+
+    def client_writer(self, client_socket, client_public_key, send_queue):
+        """Thread function to encrypt and send a client's queued messages in order"""
+        while True:
+            payload = send_queue.get()
+            if payload is None:
+                break
 
-    def broadcast_system_message(self, message):
-        """Send a system message to all clients"""
-        for client in self.clients[:]:
-            client_socket, _, client_public_key, _ = client
             try:
-                encrypted_message = rsa.encrypt(message.encode(), client_public_key)
-                client_socket.send(encrypted_message)
+                client_socket.send(rsa.encrypt(payload, client_public_key))
             except Exception:
-                # If sending fails, assume client disconnected
+                # If sending fails, assume client disconnected. This runs outside
+                # any broadcast, so the leave messages get the next sequence numbers
                 self.remove_client(client_socket)
 
-    def send_message_to_client(self, client_socket, client_public_key, sender, message):
-        """Encrypt and send a message to a specific client"""
-        formatted_message = f"{sender}: {message}"
-
-        # RSA can only encrypt limited amount of data, so we need to handle large messages
-        # For simplicity, we'll just truncate messages that are too long
-        max_msg_length = (
-            self.encryption_size // 8 - 42
-        )  # RSA overhead is 42 bytes for PKCS#1 v1.5
-        if len(formatted_message) > max_msg_length:
-            formatted_message = (
-                formatted_message[:max_msg_length] + "... (message truncated)"
-            )
-
-        encrypted_message = rsa.encrypt(formatted_message.encode(), client_public_key)
-        client_socket.send(encrypted_message)
+                # Unblock the recv loop in handle_client so the connection
+                # doesn't outlive its "left the chat" message
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
 
     def remove_client(self, client_socket):
         """Remove a client from the clients list"""
-        for i, client in enumerate(self.clients):
-            if client[0] == client_socket:
-                _, _, _, username = client
-                self.clients.pop(i)
-                print(f"{username} has disconnected")
-                self.broadcast_message("SERVER", f"{username} has left the chat")
-
-                # Send updated user count
-                user_count_msg = f"USERCOUNT:{len(self.clients)}"
-                self.broadcast_system_message(user_count_msg)
-                break
+        with self.lock:
+            for i, client in enumerate(self.clients):
+                if client[0] == client_socket:
+                    _, _, _, username, _, send_queue = client
+                    self.clients.pop(i)
+
+                    # Stop the client's writer thread
+                    send_queue.put(None)
+
+                    print(f"{username} has disconnected")
+                    self.broadcast_message(SERVER_SENDER_NAME, f"{username} has left the chat")
+
+                    # Send updated user count
+                    self.broadcast_system_message(MessageKind.USERCOUNT, str(len(self.clients)))
+                    break
 
 
 if __name__ == "__main__":